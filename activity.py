@@ -20,6 +20,8 @@
 import os
 import logging
 import subprocess
+import tempfile
+import threading
 
 import gi
 
@@ -48,7 +50,7 @@ from sugar3.datastore import datastore
 from sugar3.graphics.alert import NotifyAlert
 from sugar3 import profile
 
-from pytagcloud import (FONT_CACHE, LAYOUT_HORIZONTAL, LAYOUT_VERTICAL,
+from pytagcloud import (FONT_REGISTRY, LAYOUT_HORIZONTAL, LAYOUT_VERTICAL,
                         LAYOUT_MIX, LAYOUT_FORTYFIVE, LAYOUT_RANDOM)
 from pytagcloud.colors import COLOR_SCHEMES
 
@@ -90,6 +92,109 @@ def json_dump(data):
     return _io.getvalue()
 
 
+# seconds stop() gives the server to finish before killing it
+STOP_TIMEOUT = 1
+
+
+class RenderServer(object):
+    """
+    A long lived wordcloud.py --serve process, restarted if it dies.
+    render() blocks, run it from a thread; renders from several threads
+    take turns. cancel() may be called from another one.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._proc = None
+        self._busy = None  # the process a render is waiting on
+        self._lock = threading.Lock()
+        # held for a whole request and reply exchange
+        self._request_lock = threading.Lock()
+
+    def _start(self):
+        env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT='1')
+        self._proc = subprocess.Popen([self._path, '--serve'],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, env=env)
+
+    def start(self):
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self._start()
+            return self._proc
+
+    def render(self, request, progress=None, wanted=None):
+        """
+        Render a cloud, returns the png data. progress(placed, total) is
+        called from this thread. wanted() is asked once it is this
+        render's turn, if it is false nothing is rendered and None is
+        returned. Raises CalledProcessError on failure or when cancelled
+        """
+        with self._request_lock:
+            with self._lock:
+                # checked with the lock held, a cancel() made after
+                # wanted() turns false can't miss the render
+                if wanted is not None and not wanted():
+                    return None
+                if self._proc is None or self._proc.poll() is not None:
+                    self._start()
+                proc = self._busy = self._proc
+            reply = None
+            try:
+                request = dict(request, progress=progress is not None)
+                proc.stdin.write((json_dump(request) + '\n').encode('utf-8'))
+                proc.stdin.flush()
+                for line in iter(proc.stdout.readline, b''):
+                    reply = json_load(line.decode('utf-8'))
+                    if 'status' in reply:
+                        data = proc.stdout.read(reply['length'])
+                        break
+                    progress(reply['placed'], reply['total'])
+                    reply = None
+            except (IOError, OSError, ValueError):
+                reply = None
+            with self._lock:
+                self._busy = None
+            if reply is None or len(data) < reply['length']:
+                # it died on this request, the next one starts a fresh
+                # server
+                returncode = proc.wait()
+                with self._lock:
+                    if self._proc is proc:
+                        self._proc = None
+                raise subprocess.CalledProcessError(returncode, self._path)
+        if reply['status'] != 0:
+            if 'error' in reply:
+                logging.error(reply['error'])
+            raise subprocess.CalledProcessError(reply['status'], self._path)
+        return data
+
+    def cancel(self):
+        """
+        Kill the server busy with a render, if there is one, and start a
+        fresh one in its place so the next render finds it warm
+        """
+        with self._lock:
+            proc = self._busy
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+                if proc is self._proc:
+                    self._start()
+
+    def stop(self):
+        """ Ask the server to exit, killing it if it is still busy """
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                self._proc.stdin.close()
+                try:
+                    self._proc.wait(STOP_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    # a long render, do not hold up the window closing
+                    self._proc.kill()
+                    self._proc.wait()
+            self._proc = None
+
+
 def _hex(color):
     ''' created a #RRGGBB from a (r, g, b) color '''
     return '#%02x%02x%02x' % (color)
@@ -163,6 +268,19 @@ def _color_icon(colors, selected=False):
     return pixbuf
 
 
+def png_to_pixbuf(data, width, height):
+    ''' Load pixbuf from png data, scaled to fit width x height '''
+    def size_prepared_cb(pl, w, h):
+        scale = min(float(width) / w, float(height) / h)
+        pl.set_size(int(w * scale), int(h * scale))
+
+    pl = GdkPixbuf.PixbufLoader.new_with_type('png')
+    pl.connect('size-prepared', size_prepared_cb)
+    pl.write(data)
+    pl.close()
+    return pl.get_pixbuf()
+
+
 def svg_str_to_pixbuf(string):
     ''' Load pixbuf from SVG string '''
     pl = GdkPixbuf.PixbufLoader.new_with_type('svg')
@@ -189,6 +307,14 @@ class WordCloudActivity(activity.Activity):
         self._color_scheme = self._xo_colors
         self._repeat_tags = False
         self.image_no = 0
+        self._job = 0  # the render whose result we still want, if any
+        self._jobs_started = 0
+
+        # warm up the renderer while the user types
+        self._renderer = RenderServer(
+            os.path.join(activity.get_bundle_path(), 'wordcloud.py'))
+        self._renderer.start()
+        self.connect('destroy', self.__destroy_cb)
 
         self._toolbox = ToolbarBox()
 
@@ -277,6 +403,13 @@ class WordCloudActivity(activity.Activity):
         self._toolbox.toolbar.insert(self._layout_button, -1)
         self._layout_button.show()
 
+        self._progress_bar = Gtk.ProgressBar()
+        self._progress_bar.set_valign(Gtk.Align.CENTER)
+        progress_item = Gtk.ToolItem()
+        progress_item.add(self._progress_bar)
+        self._toolbox.toolbar.insert(progress_item, -1)
+        progress_item.show()
+
         separator = Gtk.SeparatorToolItem()
         separator.props.draw = False
         separator.set_expand(True)
@@ -287,8 +420,9 @@ class WordCloudActivity(activity.Activity):
         self._toolbox.toolbar.insert(stop_button, -1)
         stop_button.show()
 
-        self._show_image(os.path.join(
-            activity.get_bundle_path(), 'WordCloud.png'))
+        with open(os.path.join(activity.get_bundle_path(),
+                               'WordCloud.png'), 'rb') as fd:
+            self._show_image(fd.read())
 
         self._set_color('XO')
         self._set_font('Droid Sans')
@@ -309,7 +443,7 @@ class WordCloudActivity(activity.Activity):
         self.metadata['text'] = self._text_item.get_text_from_buffer()
         self.metadata['image_no'] = self.image_no
 
-    def _show_image(self, path):
+    def _show_image(self, data):
         if Gdk.Screen.height() < Gdk.Screen.width():
             height = Gdk.Screen.height() - style.GRID_CELL_SIZE
             width = int(height * 4 / 3)
@@ -317,8 +451,7 @@ class WordCloudActivity(activity.Activity):
             width = Gdk.Screen.width()
             height = int(width * 3 / 4)
 
-        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            path, width, height)
+        pixbuf = png_to_pixbuf(data, width, height)
 
         image = Gtk.Image()
         image.set_from_pixbuf(pixbuf)
@@ -340,6 +473,9 @@ class WordCloudActivity(activity.Activity):
     def __realize_cb(self, window):
         self.window_xid = window.get_window().get_xid()
 
+    def __destroy_cb(self, window):
+        self._renderer.stop()
+
     def _repeat_cb(self, widget):
         self._repeat_tags = not self._repeat_tags
 
@@ -365,45 +501,82 @@ class WordCloudActivity(activity.Activity):
         if len(text) > 0:
             self.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
 
-            GLib.idle_add(self._create_image, text)
+            self._create_image(text)
 
     def _create_image(self, text):
-        fd = open('/tmp/cloud_data.txt', 'w')
-        data = json_dump({'repeat': self._repeat_tags,
-                          'layout': self._layout,
-                          'font': self._font_name,
-                          'colors': self._color_scheme})
-        fd.write(data)
-        fd.close()
-        fd = open('/tmp/cloud_text.txt', 'w')
-        fd.write(text)
-        fd.close()
-        path = os.path.join('/tmp/cloud_large.png')
+        replaced = self._job
+        self._jobs_started += 1
+        self._job = self._jobs_started
+        if replaced:
+            # a new Go press replaces the cloud still being rendered, or
+            # still waiting for its turn
+            self._renderer.cancel()
+        self._progress_bar.set_fraction(0)
+        self._progress_bar.show()
+        request = {'repeat': self._repeat_tags,
+                   'layout': self._layout,
+                   'font': self._font_name,
+                   'colors': self._color_scheme,
+                   'text': text}
+        thread = threading.Thread(target=self._render_thread,
+                                  args=(self._job, request))
+        thread.daemon = True
+        thread.start()
+
+    def _render_thread(self, job, request):
+        def progress(placed, total):
+            GLib.idle_add(self._render_progress_cb, job, placed, total)
+
+        def wanted():
+            return job == self._job
+
         try:
-            subprocess.check_call(
-                [os.path.join(activity.get_bundle_path(), 'wordcloud.py')])
+            data = self._renderer.render(request, progress, wanted)
+            error = None
         except subprocess.CalledProcessError as e:
-            self.get_window().set_cursor(
-                Gdk.Cursor.new(Gdk.CursorType.LEFT_PTR))
-            alert = NotifyAlert(5)
-            alert.props.title = _('WordCloud error')
-            logging.error(e)
-            logging.error(e.returncode)
-            if e.returncode == 255:
-                logging.error('STOP WORD ERROR')
-                MESSAGE = _('All of your words are "stop words."'
-                            ' Please try adding more words.')
-            else:
-                logging.error('MEMORY ERROR')
-                MESSAGE = _('Oops. There was a problem. Please try again.')
-            alert.props.msg = MESSAGE
-            alert.connect('response', self._remove_alert_cb)
-            self.add_alert(alert)
-            return
+            data = None
+            error = e
+        GLib.idle_add(self._render_done_cb, job, data, error)
+
+    def _render_progress_cb(self, job, placed, total):
+        if job == self._job:
+            self._progress_bar.set_fraction(float(placed) / total)
+        return False
+
+    def _render_done_cb(self, job, data, error):
+        if job != self._job:
+            # cancelled
+            return False
+        self._job = 0
+        self._progress_bar.hide()
+        if error is not None:
+            self._create_image_error(error)
+        else:
+            self._create_image_done(data)
+        return False
+
+    def _create_image_error(self, e):
+        self.get_window().set_cursor(
+            Gdk.Cursor.new(Gdk.CursorType.LEFT_PTR))
+        alert = NotifyAlert(5)
+        alert.props.title = _('WordCloud error')
+        logging.error(e)
+        logging.error(e.returncode)
+        if e.returncode == 255:
+            logging.error('STOP WORD ERROR')
+            MESSAGE = _('All of your words are "stop words."'
+                        ' Please try adding more words.')
+        else:
+            logging.error('MEMORY ERROR')
+            MESSAGE = _('Oops. There was a problem. Please try again.')
+        alert.props.msg = MESSAGE
+        alert.connect('response', self._remove_alert_cb)
+        self.add_alert(alert)
 
+    def _create_image_done(self, data):
         self.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.LEFT_PTR))
 
-        self._show_image(path)
+        self._show_image(data)
 
         if "image_no" in self.metadata:
             self.image_no = int(self.metadata["image_no"])
@@ -411,8 +584,15 @@ class WordCloudActivity(activity.Activity):
         dsobject.metadata['title'] = _('Word Cloud-{}'.format(self.image_no))
         dsobject.metadata['icon-color'] = profile.get_color().to_string()
         dsobject.metadata['mime_type'] = 'image/png'
+        # the journal copies from a file, one of our own so that
+        # instances don't share it; the datastore takes it over
+        fd, path = tempfile.mkstemp(
+            suffix='.png',
+            dir=os.path.join(self.get_activity_root(), 'instance'))
+        with os.fdopen(fd, 'wb') as png:
+            png.write(data)
         dsobject.set_file_path(path)
-        datastore.write(dsobject)
+        datastore.write(dsobject, transfer_ownership=True)
         dsobject.destroy()
         self.image_no += 1
 
@@ -450,9 +630,7 @@ class WordCloudActivity(activity.Activity):
             clipboard, None, True)
 
     def _init_font_list(self):
-        self._font_list = []
-        for f in FONT_CACHE:
-            self._font_list.append(f['name'])
+        self._font_list = FONT_REGISTRY.names()
         return
 
     def _setup_font_palette(self):
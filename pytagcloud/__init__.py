@@ -1,14 +1,30 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from copy import copy
-from math import sin, cos
+from io import BytesIO
+from math import sin, cos, log, ceil
+from operator import itemgetter
 from pygame import transform, font, mask, Surface, Rect, SRCALPHA, draw
+from pygame import BLEND_RGBA_MULT
 from pygame.sprite import Group, Sprite, collide_mask
-from random import randint, choice
+from random import Random
+from xml.sax.saxutils import escape, quoteattr
+import random
 import colorsys
+import heapq
 import os
 import pygame
 import json
 import logging
+import threading
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 TAG_PADDING = 5
@@ -19,19 +35,30 @@ ECCENTRICITY = 1.5
 LOWER_START = 0.45
 UPPER_START = 0.55
 
+# font sizes are laid out at this scale, the layout is zoomed to size
+LAYOUT_SCALE = 1.0
+
 FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts')
 DEFAULT_FONT = 'Droid Sans'
 DEFAULT_PALETTE = 'default'
-fd = open(os.path.join(FONT_DIR, 'fonts.json'), 'r')
-FONT_CACHE = json.loads(fd.read())
+FONT_CACHE_SIZE = 32  # number of (ttf, size) Font objects kept alive
+GLYPH_CACHE_BYTES = 64 * 1024 * 1024  # budget for rendered words and masks
 
 # pygame.init()
 
-convsurf = Surface((2 * TAG_PADDING, 2 * TAG_PADDING))
-convsurf.fill((255, 0, 255))
-convsurf.set_colorkey((255, 0, 255))
-draw.circle(convsurf, (0, 0, 0), (TAG_PADDING, TAG_PADDING), TAG_PADDING)
-CONVMASK = mask.from_surface(convsurf)
+
+def _padding_disc(padding):
+    """
+    The disc a glyph mask is dilated with, to keep words padding apart
+    """
+    convsurf = Surface((2 * padding, 2 * padding))
+    convsurf.fill((255, 0, 255))
+    convsurf.set_colorkey((255, 0, 255))
+    draw.circle(convsurf, (0, 0, 0), (padding, padding), padding)
+    return mask.from_surface(convsurf)
+
+
+CONVMASK = _padding_disc(TAG_PADDING)
 
 LAYOUT_HORIZONTAL = 0
 LAYOUT_VERTICAL = 1
@@ -51,7 +78,29 @@ LAYOUTS = (
     LAYOUT_RANDOM
 )
 
-LAST_COLLISON_HIT = None
+# per-sprite mask tests, narrowed by a grid over the tag rects
+ENGINE_SPRITES = 0
+# a single mask accumulating all placed tags
+ENGINE_OCCUPANCY = 1
+# occupancy mask, with a correlation over all offsets for long searches
+# (needs numpy)
+ENGINE_CORRELATION = 2
+
+ENGINES = (
+    ENGINE_SPRITES,
+    ENGINE_OCCUPANCY,
+    ENGINE_CORRELATION
+)
+
+INDEX_CELL_SIZE = 64  # px, cell size of the collision broad phase grid
+OCCUPANCY_MARGIN = 256  # px, slack added each time the occupancy grows
+SPIRAL_CHUNK = 1024  # offsets computed at a time when a spiral table grows
+CORRELATION_STEPS = 20000  # spiral steps tried before correlating
+PYRAMID_LEVELS = (16, 4)  # coarse collision levels, coarse to fine
+PYRAMID_MIN_AREA = 32768  # px, smaller glyphs are only tested at full size
+GLYPH_CHUNK = 16  # words rendered per task when preparing in a pool
+SHRINK_FACTOR = 0.75  # size kept by a tag retried smaller
+DEADLINE_STEPS = 256  # spiral steps between checks of the layout deadline
 
 
 '''
@@ -78,40 +127,447 @@ def __draw_cb(self, canvas, cr):
     cr.paint()
 
 
+class FontRegistry(object):
+    """
+    The fonts listed in a fonts.json, read on first use and indexed by
+    name and by ttf file name. Entries whose ttf file is missing are
+    dropped once, at load time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fonts = None
+        self._by_name = {}
+        self._by_ttf = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._fonts is not None:
+                return self._fonts
+            with open(self.path, 'r') as fd:
+                specs = json.load(fd)
+            fonts = []
+            for spec in specs:
+                if not os.path.exists(os.path.join(FONT_DIR, spec['ttf'])):
+                    logging.warning(
+                        'font file {} not found'.format(spec['ttf']))
+                    continue
+                fonts.append(spec)
+                self._by_name[spec['name']] = spec
+                self._by_ttf[spec['ttf']] = spec
+            self._fonts = fonts
+            return fonts
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def names(self):
+        return [spec['name'] for spec in self._load()]
+
+    def get(self, name):
+        self._load()
+        if name not in self._by_name:
+            raise AttributeError('Invalid font name. Should be one of %s' %
+                                 ", ".join(self.names()))
+        return self._by_name[name]
+
+    def get_by_ttf(self, ttf):
+        self._load()
+        return self._by_ttf.get(ttf)
+
+
+FONT_REGISTRY = FontRegistry(os.path.join(FONT_DIR, 'fonts.json'))
+
+
+class FontCache(object):
+    """
+    Bounded LRU cache of pygame Font objects keyed on (ttf, size).
+    With keep_files the TTF bytes are read once and fonts are created from
+    memory afterwards. Font objects die with pygame.font, call clear()
+    before quitting it; the TTF bytes survive. Safe to share by threads.
+    """
+
+    def __init__(self, maxsize=FONT_CACHE_SIZE, keep_files=True):
+        self.maxsize = maxsize
+        self.keep_files = keep_files
+        self.fonts = OrderedDict()
+        self.files = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _source(self, ttf):
+        path = os.path.join(FONT_DIR, ttf)
+        if not self.keep_files:
+            return path
+        if ttf not in self.files:
+            with open(path, 'rb') as fd:
+                self.files[ttf] = fd.read()
+        # every Font reads from its own file object
+        return BytesIO(self.files[ttf])
+
+    def get(self, ttf, size):
+        key = (ttf, size)
+        with self.lock:
+            if key in self.fonts:
+                self.hits += 1
+                self.fonts.move_to_end(key)
+                return self.fonts[key]
+            self.misses += 1
+            fnt = font.Font(self._source(ttf), size)
+            self.fonts[key] = fnt
+            if len(self.fonts) > self.maxsize:
+                self.fonts.popitem(last=False)
+            return fnt
+
+    def clear(self):
+        with self.lock:
+            self.fonts.clear()
+
+
+font_cache = FontCache()
+
+
+def _kernel_runs(kernel, offset):
+    """
+    Split a kernel into horizontal runs of set bits. Returns a dict
+    mapping the (first, last) x shift of a run to the y shifts of the rows
+    it appears in, with the shifts Mask.convolve(kernel, None, offset)
+    would apply.
+    """
+    kw, kh = kernel.get_size()
+    runs = {}
+    for ky in range(kh):
+        kx = 0
+        while kx < kw:
+            if not kernel.get_at((kx, ky)):
+                kx += 1
+                continue
+            start = kx
+            while kx < kw and kernel.get_at((kx, ky)):
+                kx += 1
+            shifts = (kw - kx + offset[0], kw - 1 - start + offset[0])
+            runs.setdefault(shifts, []).append(kh - 1 - ky + offset[1])
+    return runs
+
+
+# padding: (kernel size, kernel runs), a layout_scale below 1 pads less
+KERNEL_RUNS = {TAG_PADDING: (CONVMASK.get_size(),
+                             _kernel_runs(CONVMASK,
+                                          (TAG_PADDING, TAG_PADDING)))}
+
+
+def _padding_runs(padding):
+    """
+    The size and runs of the padding disc, computed once per padding
+    """
+    if padding not in KERNEL_RUNS:
+        disc = _padding_disc(padding)
+        # two threads may both compute it, the results are the same
+        KERNEL_RUNS[padding] = (disc.get_size(),
+                                _kernel_runs(disc, (padding, padding)))
+    return KERNEL_RUNS[padding]
+
+
+def _padded_mask(surface, padding=TAG_PADDING):
+    """
+    Dilate the glyph mask with a disc of radius padding (CONVMASK by
+    default). Same result as Mask.convolve but each distinct row of the
+    kernel is built once, by log2(run length) shifted draws, and then
+    drawn once per row it appears in; the cost does not grow with kernel
+    area.
+    """
+    # all of the ink, at small (or proxy) sizes most of the glyph is too
+    # faint for the default threshold and the word is drawn bigger later
+    src = mask.from_surface(surface, 1)
+    w, h = src.get_size()
+    (kw, kh), runs = _padding_runs(padding)
+    padded = mask.Mask((w + kw - 1, h + kh - 1))
+    for (first, last), rows in runs.items():
+        line = mask.Mask((w + kw - 1, h))
+        line.draw(src, (first, 0))
+        length = last - first + 1
+        covered = 1
+        while covered < length:
+            step = min(covered, length - covered)
+            line.draw(line.copy(), (step, 0))
+            covered += step
+        for dy in rows:
+            padded.draw(line, (0, dy))
+    return padded
+
+
+def _reduce_mask(msk, factor, solid=False):
+    """
+    Downsample a mask by factor (a power of two). A coarse bit is set if
+    any bit of its block is set, or with solid, if all of them are.
+    """
+    w, h = msk.get_size()
+    cw = -(-w // factor)
+    ch = -(-h // factor)
+    blocks = mask.Mask((cw * factor, ch * factor))
+    blocks.draw(msk, (0, 0))
+    if solid:
+        blocks.invert()
+    # fold every block into its top left bit
+    step = 1
+    while step < factor:
+        blocks.draw(blocks.copy(), (-step, 0))
+        step *= 2
+    step = 1
+    while step < factor:
+        blocks.draw(blocks.copy(), (0, -step))
+        step *= 2
+    coarse = blocks.scale((cw, ch))
+    if solid:
+        coarse.invert()
+    return coarse
+
+
+def _mask_pyramid(msk):
+    """
+    Per level of PYRAMID_LEVELS, the OR reduced mask grown by one cell to
+    the right and bottom (covers the glyph at any offset within a cell)
+    and the solid cells of the glyph. Empty for masks below
+    PYRAMID_MIN_AREA, a full size overlap is as cheap for those.
+    """
+    w, h = msk.get_size()
+    if w * h < PYRAMID_MIN_AREA:
+        return ()
+    pyramid = []
+    for factor in PYRAMID_LEVELS:
+        coarse = _reduce_mask(msk, factor)
+        cw, ch = coarse.get_size()
+        spread = mask.Mask((cw + 1, ch + 1))
+        for offset in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            spread.draw(coarse, offset)
+        pyramid.append((factor, spread, _reduce_mask(msk, factor, True)))
+    return pyramid
+
+
+def _render_word(word, ttf, size, angle=0):
+    """
+    The word in white, cropped to its ink and rotated by angle, and the
+    font offset of the crop
+    """
+    tag_font = font_cache.get(ttf, size)
+    # an SDL_ttf font can't render in two threads at once
+    with font_cache.lock:
+        fonter = tag_font.render(word, True, (255, 255, 255))
+    frect = fonter.get_bounding_rect()
+    frect.x = -frect.x
+    frect.y = -frect.y
+    surface = Surface((frect.width, frect.height), SRCALPHA, 32)
+    surface.blit(fonter, frect)
+    if angle % 360:
+        surface = transform.rotate(surface, angle % 360)
+    return surface, (-frect.x, -frect.y)
+
+
+class GlyphCache(object):
+    """
+    Memory bounded LRU cache of rendered words keyed on
+    (word, ttf, size, angle, padding). Words are rendered in white so
+    entries are colour independent; the colour is multiplied in at blit
+    time.
+    Entries are (surface, padded mask, font offset) and must not be
+    modified. Safe to share by threads. Words render outside the lock, two
+    threads missing the same word both render it and the first one is kept.
+    """
+
+    def __init__(self, maxbytes=GLYPH_CACHE_BYTES):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.glyphs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # reentrant, get() puts with it held
+        self.lock = threading.RLock()
+
+    def _render(self, word, ttf, size, angle, padding=TAG_PADDING):
+        if angle:
+            upright, _, offset = self.get(word, ttf, size, 0, padding)
+            surface = transform.rotate(upright, angle)
+            return surface, _padded_mask(surface, padding), offset
+
+        surface, offset = _render_word(word, ttf, size)
+        return surface, _padded_mask(surface, padding), offset
+
+    def get(self, word, ttf, size, angle=0, padding=TAG_PADDING):
+        key = (word, ttf, size, angle % 360, padding)
+        with self.lock:
+            if key in self.glyphs:
+                self.hits += 1
+                self.glyphs.move_to_end(key)
+                return self.glyphs[key]
+            self.misses += 1
+        glyph = self._render(word, ttf, size, angle % 360, padding)
+        with self.lock:
+            if key in self.glyphs:
+                return self.glyphs[key]
+            self.put(word, ttf, size, angle, glyph, padding)
+            return glyph
+
+    def put(self, word, ttf, size, angle, glyph, padding=TAG_PADDING):
+        key = (word, ttf, size, angle % 360, padding)
+        with self.lock:
+            if key in self.glyphs:
+                self.nbytes -= self._sizeof(self.glyphs.pop(key))
+            self.glyphs[key] = glyph
+            self.nbytes += self._sizeof(glyph)
+            while self.nbytes > self.maxbytes and len(self.glyphs) > 1:
+                _, old = self.glyphs.popitem(last=False)
+                self.nbytes -= self._sizeof(old)
+
+    def _sizeof(self, glyph):
+        surface, padded, _ = glyph
+        w, h = surface.get_size()
+        mw, mh = padded.get_size()
+        return w * h * 4 + (mw + 7) // 8 * mh
+
+    def clear(self):
+        with self.lock:
+            self.glyphs.clear()
+            self.nbytes = 0
+
+
+glyph_cache = GlyphCache()
+
+
+class PygameSession(object):
+    """
+    pygame.init() shared by the renders running at a time, in any thread.
+    The last render to finish quits pygame again, unless it was up before
+    the first one started (a caller that keeps pygame up keeps it warm).
+    """
+
+    def __init__(self):
+        self.renders = 0
+        self.started = False
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            if not self.renders:
+                self.started = not pygame.get_init()
+                pygame.init()
+            self.renders += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.renders -= 1
+            if not self.renders and self.started:
+                font_cache.clear()
+                pygame.quit()
+
+
+pygame_session = PygameSession()
+
+
+def _pack_glyph(glyph):
+    """
+    Picklable form of a glyph, surfaces and masks can't be pickled. The
+    mask goes as a one byte per pixel image; both buffers compress well
+    """
+    surface, padded, offset = glyph
+    bits = Surface(padded.get_size(), 0, 8)
+    bits.set_palette_at(1, (255, 255, 255))
+    padded.to_surface(bits, setcolor=(255, 255, 255), unsetcolor=(0, 0, 0))
+    return (surface.get_size(),
+            zlib.compress(pygame.image.tobytes(surface, 'RGBA'), 1),
+            padded.get_size(),
+            zlib.compress(pygame.image.tobytes(bits, 'P'), 1),
+            offset)
+
+
+def _unpack_glyph(packed):
+    size, pixels, mask_size, bits, offset = packed
+    surface = pygame.image.frombytes(zlib.decompress(pixels), size, 'RGBA')
+    bits = pygame.image.frombytes(zlib.decompress(bits), mask_size, 'P')
+    bits.set_palette_at(0, (0, 0, 0))
+    bits.set_colorkey((0, 0, 0))
+    return surface, mask.from_surface(bits), offset
+
+
+def _glyph_worker(job):
+    """
+    Render an upright glyph in a worker process
+    """
+    if not font.get_init():
+        font.init()
+    word, ttf, size, padding = job
+    return _pack_glyph(glyph_cache._render(word, ttf, size, 0, padding))
+
+
+def _prepare_glyphs(tag_list, fontname, workers, padding=TAG_PADDING):
+    """
+    Render the glyphs of tag_list into glyph_cache in a pool of workers
+    processes. Yields the tags in order as their glyph arrives, so the
+    first (biggest) words are placed while the rest are still rendering
+    """
+    ttf = load_font(fontname)['ttf']
+    missing = OrderedDict()
+    for tag in tag_list:
+        key = (tag['tag'], ttf, tag['size'], 0, padding)
+        if key not in glyph_cache.glyphs:
+            missing[key] = (tag['tag'], ttf, tag['size'], padding)
+    if not missing:
+        for tag in tag_list:
+            yield tag
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        rendered = pool.map(_glyph_worker, missing.values(),
+                            chunksize=GLYPH_CHUNK)
+        try:
+            for tag in tag_list:
+                # missing is in first use order, the next result is this
+                key = (tag['tag'], ttf, tag['size'], 0, padding)
+                if key in missing:
+                    del missing[key]
+                    glyph_cache.put(tag['tag'], ttf, tag['size'], 0,
+                                    _unpack_glyph(next(rendered)), padding)
+                yield tag
+        finally:
+            # closed early by a layout out of time, skip the rest
+            pool.shutdown(cancel_futures=True)
+
+
 class Tag(Sprite):
     """
     Font tag sprite. Blit the font to a surface to correct the font padding
+    The image is the uncoloured glyph shared with glyph_cache, it is only
+    used to place the tag; a placed tag is drawn from its Placement. The
+    mask keeps padding pixels around the ink.
     """
 
-    def __init__(self, tag, initial_position, fontname=DEFAULT_FONT):
+    def __init__(self, tag, initial_position, fontname=DEFAULT_FONT,
+                 padding=TAG_PADDING):
         Sprite.__init__(self)
         self.tag = copy(tag)
         self.rotation = 0
+        self.padding = padding
 
         self.font_spec = load_font(fontname)
-        self.font = font.Font(os.path.join(FONT_DIR,
-                                           self.font_spec['ttf']),
-                              self.tag['size'])
-        # fonter = self.font.render(unicode(tag['tag'], 'UTF-8'), True,
-        fonter = self.font.render(tag['tag'], True, tag['color'])
-        frect = fonter.get_bounding_rect()
-        frect.x = -frect.x
-        frect.y = -frect.y
-        self.fontoffset = (-frect.x, -frect.y)
-        font_sf = Surface((frect.width, frect.height), pygame.SRCALPHA, 32)
-        font_sf.blit(fonter, frect)
-        self.image = font_sf
-        self.rect = font_sf.get_rect()
-        self.rect.width += TAG_PADDING
-        self.rect.height += TAG_PADDING
+        self.image, self.mask, self.fontoffset = glyph_cache.get(
+            tag['tag'], self.font_spec['ttf'], self.tag['size'], 0, padding)
+        self.rect = self.image.get_rect()
+        self.rect.width += padding
+        self.rect.height += padding
         self.rect.x = initial_position[0]
         self.rect.y = initial_position[1]
-        self._update_mask()
+        self.pyramid = _mask_pyramid(self.mask)
 
     def _update_mask(self):
-        self.mask = mask.from_surface(self.image)
-        self.mask = self.mask.convolve(CONVMASK, None,
-                                       (TAG_PADDING, TAG_PADDING))
+        self.image, self.mask, _ = glyph_cache.get(
+            self.tag['tag'], self.font_spec['ttf'], self.tag['size'],
+            self.rotation, self.padding)
+        self.pyramid = _mask_pyramid(self.mask)
 
     def flip(self):
         angle = 90 if self.rotation == 0 else - 90
@@ -119,22 +575,107 @@ class Tag(Sprite):
 
     def rotate(self, angle):
         pos = (self.rect.x, self.rect.y)
-        self.image = transform.rotate(self.image, angle)
+        if angle % 360:
+            self.rotation = (self.rotation + angle) % 360
+            self._update_mask()
         self.rect = self.image.get_rect()
         self.rect.x, self.rect.y = pos
+
+    def resize(self, size):
+        pos = (self.rect.x, self.rect.y)
+        self.tag['size'] = size
         self._update_mask()
+        self.rect = self.image.get_rect()
+        self.rect.x, self.rect.y = pos
 
-    def update_fontsize(self):
-        self.font = font.Font(os.path.join(FONT_DIR, self.font_spec['ttf']),
-                              self.tag['size'])
+    def release(self):
+        """
+        Drop the glyph of a placed tag, the rect stays
+        """
+        self.image = self.mask = None
+        self.pyramid = ()
+
+
+class Placement(object):
+    """
+    A placed word: what it takes to draw it again, without the glyph and
+    mask it was placed with. angle is in degrees, rect the ink box of the
+    rotated word.
+    """
+
+    __slots__ = ('word', 'size', 'angle', 'rect', 'color')
+
+    def __init__(self, word, size, angle, rect, color):
+        self.word = word
+        self.size = size
+        self.angle = angle
+        self.rect = rect
+        self.color = color
+
+    @classmethod
+    def from_tag(cls, tag_sprite):
+        return cls(tag_sprite.tag['tag'], tag_sprite.tag['size'],
+                   tag_sprite.rotation, tag_sprite.rect,
+                   tag_sprite.tag['color'])
+
+    def render(self, ttf, scale=1):
+        """
+        The word in its colour, at its angle and size times scale
+        """
+        surface, _ = _render_word(self.word, ttf, int(self.size * scale),
+                                  self.angle)
+        surface.fill(tuple(self.color) + (255,),
+                     special_flags=BLEND_RGBA_MULT)
+        return surface
+
+    def svg_text(self, ttf):
+        """
+        The word as an svg text element, its ink centred on the rect. The
+        ink box comes from the glyph metrics, nothing is rendered
+        """
+        tag_font = font_cache.get(ttf, self.size)
+        with font_cache.lock:
+            word_metrics = tag_font.metrics(self.word)
+        left = top = right = bottom = None
+        pen = 0
+        for metrics in word_metrics:
+            if metrics is None:
+                continue
+            minx, maxx, miny, maxy, advance = metrics
+            if left is None:
+                left, right = pen + minx, pen + maxx
+                top, bottom = -maxy, -miny
+            else:
+                left, right = min(left, pen + minx), max(right, pen + maxx)
+                top, bottom = min(top, -maxy), max(bottom, -miny)
+            pen += advance
+        if left is None:
+            # no glyph metrics, use the line box
+            width, height = tag_font.size(self.word)
+            left, right = 0, width
+            top = -tag_font.get_ascent()
+            bottom = top + height
+
+        cx = self.rect.x + self.rect.w / 2.0
+        cy = self.rect.y + self.rect.h / 2.0
+        rotate = ''
+        if self.angle:
+            # pygame rotates counterclockwise, svg clockwise
+            rotate = ' transform="rotate({} {:.1f} {:.1f})"'.format(
+                -self.angle, cx, cy)
+        return '<text x="{:.1f}" y="{:.1f}" font-size="{}" fill="{}"{}>' \
+            '{}</text>'.format(cx - (left + right) / 2.0,
+                               cy - (top + bottom) / 2.0, self.size,
+                               _hex_color(self.color), rotate,
+                               escape(self.word))
+
+
+def _hex_color(color):
+    return '#%02x%02x%02x' % tuple(color[:3])
 
 
 def load_font(name):
-    for font in FONT_CACHE:
-        if font['name'].encode('utf-8') == name.encode('utf-8'):
-            return font
-    raise AttributeError('Invalid font name. Should be one of %s' %
-                         ", ".join([f['name'] for f in FONT_CACHE]))
+    return FONT_REGISTRY.get(name)
 
 
 def defscale(count, mincount, maxcount, minsize, maxsize):
@@ -144,16 +685,51 @@ def defscale(count, mincount, maxcount, minsize, maxsize):
                (count * 1.0 / (maxcount - mincount)) ** 0.8)
 
 
-def make_tags(wordcounts, minsize=3, maxsize=36, colors=None, scalef=defscale):
+def linscale(count, mincount, maxcount, minsize, maxsize):
+    if maxcount == mincount:
+        return int((maxsize - minsize) / 2.0 + minsize)
+    return int(minsize + (maxsize - minsize) *
+               (count - mincount) * 1.0 / (maxcount - mincount))
+
+
+def logscale(count, mincount, maxcount, minsize, maxsize):
+    if maxcount == mincount:
+        return int((maxsize - minsize) / 2.0 + minsize)
+    return int(minsize + (maxsize - minsize) *
+               log(count - mincount + 1) / log(maxcount - mincount + 1))
+
+
+def _get_rng(seed):
+    """
+    seed is a number, a random.Random instance or None for the global
+    random module
+    """
+    if seed is None:
+        return random
+    if isinstance(seed, Random):
+        return seed
+    return Random(seed)
+
+
+def make_tags(wordcounts, minsize=3, maxsize=36, colors=None, scalef=defscale,
+              seed=None, max_words=None, min_count=None):
     """
     sizes and colors tags
     wordcounts is a list of tuples(tags, count). (e.g. how often the
     word appears in a text)
     the tags are assigned sizes between minsize and maxsize, the function used
-    is determined by scalef (default: square root)
+    is determined by scalef (default: defscale, or linscale or logscale)
     color is either chosen from colors (list of rgb tuples) if provided or
     random
+    seed (a number or a random.Random) makes the colors reproducible
+    only words counted at least min_count times are kept, and of those the
+    max_words most frequent (first come first on ties)
     """
+    rng = _get_rng(seed)
+    if min_count is not None:
+        wordcounts = [tag for tag in wordcounts if tag[1] >= min_count]
+    if max_words is not None and len(wordcounts) > max_words:
+        wordcounts = heapq.nlargest(max_words, wordcounts, key=itemgetter(1))
     counts = [tag[1] for tag in wordcounts]
 
     if not len(counts):
@@ -161,34 +737,297 @@ def make_tags(wordcounts, minsize=3, maxsize=36, colors=None, scalef=defscale):
 
     maxcount = max(counts)
     mincount = min(counts)
+    # word counts are mostly a handful of distinct values, size each once
+    sizes = dict((count, scalef(count, mincount, maxcount, minsize, maxsize))
+                 for count in set(counts))
     tags = []
     for word_count in wordcounts:
-        color = choice(colors) if colors else (randint(10, 220),
-                                               randint(10, 220),
-                                               randint(10, 220))
+        color = rng.choice(colors) if colors else (rng.randint(10, 220),
+                                                   rng.randint(10, 220),
+                                                   rng.randint(10, 220))
         tags.append({'color': color,
-                     'size': scalef(word_count[1], mincount,
-                                    maxcount, minsize, maxsize),
+                     'size': sizes[word_count[1]],
                      'tag': word_count[0]})
     logging.debug('tag count={}'.format(len(tags)))
     logging.debug(tags)
     return tags
 
 
-def _do_collide(sprite, group):
+def _mask_rect(sprite):
+    """
+    The padded mask is larger than the sprite rect
+    """
+    return Rect(sprite.rect.topleft, sprite.mask.get_size())
+
+
+class _SpatialIndex(object):
     """
-    Use mask based collision detection
+    Uniform grid over the placed tag masks. Used as a broad phase so that
+    only sprites whose masks may overlap the candidate are mask tested.
+    The last sprite hit is tested first, the next candidate is likely to
+    hit it again.
     """
-    global LAST_COLLISON_HIT
-    # Test if we still collide with the last hit
-    if LAST_COLLISON_HIT and collide_mask(sprite, LAST_COLLISON_HIT):
-        return True
 
-    for sp in group:
-        if collide_mask(sprite, sp):
-            LAST_COLLISON_HIT = sp
+    spiral_steps = None
+    # placed sprites are tested against, their masks must stay
+    keeps_sprites = True
+
+    def __init__(self, cell_size=INDEX_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.last_hit = None
+
+    def _cells(self, rect):
+        cs = self.cell_size
+        for gx in range(rect.left // cs, (rect.right - 1) // cs + 1):
+            for gy in range(rect.top // cs, (rect.bottom - 1) // cs + 1):
+                yield gx, gy
+
+    def add(self, sprite):
+        bounds = _mask_rect(sprite)
+        for cell in self._cells(bounds):
+            self.cells.setdefault(cell, []).append((sprite, bounds))
+
+    def rebuild(self, sprites):
+        self.cells = {}
+        for sprite in sprites:
+            self.add(sprite)
+
+    def query(self, rect):
+        found = {}
+        for cell in self._cells(rect):
+            for sprite, bounds in self.cells.get(cell, ()):
+                if sprite not in found and bounds.colliderect(rect):
+                    found[sprite] = True
+        return found
+
+    def collide(self, sprite):
+        # Test if we still collide with the last hit
+        if self.last_hit is not None and collide_mask(sprite, self.last_hit):
             return True
-    return False
+
+        for sp in self.query(_mask_rect(sprite)):
+            if collide_mask(sprite, sp):
+                self.last_hit = sp
+                return True
+        return False
+
+
+class _OccupancyMask(object):
+    """
+    One mask holding the padded glyphs of every placed tag. A collision
+    test is a single overlap, placing a tag a single draw, whatever the
+    number of tags already placed.
+    Reduced copies (PYRAMID_LEVELS) are kept too: a candidate is accepted
+    when its coarse glyph misses the coarse occupancy, rejected when one
+    of its solid cells hits a solid occupancy cell, and only otherwise
+    tested at full resolution.
+    """
+
+    spiral_steps = None
+    keeps_sprites = False
+
+    def __init__(self):
+        self.mask = None
+        self.origin = (0, 0)
+        self.levels = []
+
+    def _reduce_region(self, x, y, w, h):
+        """
+        Update the coarse levels over the occupancy region x, y, w, h
+        """
+        for factor, spread, solid in self.levels:
+            cx = x // factor
+            cy = y // factor
+            cw = -(-(x + w) // factor) - cx
+            ch = -(-(y + h) // factor) - cy
+            region = mask.Mask((cw * factor, ch * factor))
+            region.draw(self.mask, (-cx * factor, -cy * factor))
+            spread.draw(_reduce_mask(region, factor), (cx, cy))
+            solid.draw(_reduce_mask(region, factor, True), (cx, cy))
+
+    def _grow(self, rect):
+        if self.mask is None:
+            bounds = rect.inflate(2 * OCCUPANCY_MARGIN, 2 * OCCUPANCY_MARGIN)
+        else:
+            bounds = Rect(self.origin, self.mask.get_size())
+            if bounds.contains(rect):
+                return
+            bounds = bounds.union(rect.inflate(2 * OCCUPANCY_MARGIN,
+                                               2 * OCCUPANCY_MARGIN))
+        grown = mask.Mask(bounds.size)
+        if self.mask is not None:
+            grown.draw(self.mask, (self.origin[0] - bounds.x,
+                                   self.origin[1] - bounds.y))
+        self.mask = grown
+        self.origin = bounds.topleft
+        self.levels = [(factor, _reduce_mask(grown, factor),
+                        _reduce_mask(grown, factor, True))
+                       for factor in PYRAMID_LEVELS]
+
+    def add(self, sprite):
+        self._grow(_mask_rect(sprite))
+        x = sprite.rect.x - self.origin[0]
+        y = sprite.rect.y - self.origin[1]
+        self.mask.draw(sprite.mask, (x, y))
+        self._reduce_region(x, y, *sprite.mask.get_size())
+
+    def collide(self, sprite):
+        if self.mask is None:
+            return False
+        x = sprite.rect.x - self.origin[0]
+        y = sprite.rect.y - self.origin[1]
+        pyramid = sprite.pyramid
+        if not pyramid:
+            return self.mask.overlap(sprite.mask, (x, y)) is not None
+        for (factor, spread, solid), (_, glyph_spread, glyph_solid) in \
+                zip(self.levels, pyramid):
+            offset = (x // factor, y // factor)
+            if spread.overlap(glyph_spread, offset) is None:
+                return False
+            if solid.overlap(glyph_solid, offset) is not None:
+                return True
+        return self.mask.overlap(sprite.mask, (x, y)) is not None
+
+
+def _fft_size(n):
+    """
+    Smallest 2**a * 3**b * 5**c not below n
+    """
+    best = 1
+    while best < n:
+        best *= 2
+    p5 = 1
+    while p5 < 2 * n:
+        p35 = p5
+        while p35 < 2 * n:
+            size = p35
+            while size < n:
+                size *= 2
+            best = min(best, size)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def _mask_array(msk):
+    """
+    Mask as a float numpy array indexed [x, y]
+    """
+    surface = msk.to_surface(setcolor=(255, 255, 255, 255),
+                             unsetcolor=(0, 0, 0, 255))
+    return (pygame.surfarray.array_red(surface) > 0).astype(numpy.float64)
+
+
+def _correlate(window, kernel):
+    """
+    Overlap of kernel with window at every offset keeping it inside
+    """
+    ww, wh = window.shape
+    kw, kh = kernel.shape
+    shape = (_fft_size(ww), _fft_size(wh))
+    spectrum = numpy.fft.rfft2(window, shape) * \
+        numpy.conj(numpy.fft.rfft2(kernel, shape))
+    return numpy.fft.irfft2(spectrum, shape)[:ww - kw + 1, :wh - kh + 1]
+
+
+class _CorrelationIndex(_OccupancyMask):
+    """
+    Occupancy mask mirrored in a numpy array. A tag still unplaced after
+    CORRELATION_STEPS spiral steps gets the overlap with the occupancy at
+    every offset in one FFT correlation, and takes the free offset closest
+    to where the spiral started.
+    """
+
+    spiral_steps = CORRELATION_STEPS
+
+    def __init__(self):
+        _OccupancyMask.__init__(self)
+        self.grid = None
+        self.glyphs = {}
+
+    def _glyph(self, sprite):
+        # converted once per sprite and mask, find_free() and add() share it
+        glyph = self.glyphs.get(sprite)
+        if glyph is None or glyph[0] is not sprite.mask:
+            glyph = self.glyphs[sprite] = (sprite.mask,
+                                           _mask_array(sprite.mask))
+        return glyph[1]
+
+    def _grow(self, rect):
+        old_mask, old_origin = self.mask, self.origin
+        _OccupancyMask._grow(self, rect)
+        if self.mask is old_mask:
+            return
+        grid = numpy.zeros(self.mask.get_size())
+        if old_mask is not None:
+            x = old_origin[0] - self.origin[0]
+            y = old_origin[1] - self.origin[1]
+            w, h = self.grid.shape
+            grid[x:x + w, y:y + h] = self.grid
+        self.grid = grid
+
+    def add(self, sprite):
+        _OccupancyMask.add(self, sprite)
+        glyph = self._glyph(sprite)
+        x = sprite.rect.x - self.origin[0]
+        y = sprite.rect.y - self.origin[1]
+        w, h = glyph.shape
+        occupied = self.grid[x:x + w, y:y + h]
+        numpy.maximum(occupied, glyph, out=occupied)
+        del self.glyphs[sprite]
+
+    def _window(self, rect):
+        window = numpy.zeros(rect.size)
+        if self.grid is None:
+            return window
+        clip = rect.clip(Rect(self.origin, self.grid.shape))
+        if clip.w and clip.h:
+            window[clip.x - rect.x:clip.right - rect.x,
+                   clip.y - rect.y:clip.bottom - rect.y] = \
+                self.grid[clip.x - self.origin[0]:clip.right - self.origin[0],
+                          clip.y - self.origin[1]:clip.bottom - self.origin[1]]
+        return window
+
+    def _nearest_free(self, glyph, positions, target):
+        """
+        Free top left position in the positions rect closest to target
+        """
+        w, h = glyph.shape
+        window = self._window(Rect(positions.x, positions.y,
+                                   positions.w + w - 1, positions.h + h - 1))
+        if not window.any():
+            return (min(max(int(target[0]), positions.left),
+                        positions.right - 1),
+                    min(max(int(target[1]), positions.top),
+                        positions.bottom - 1))
+        xs, ys = numpy.nonzero(_correlate(window, glyph) < 0.5)
+        if not len(xs):
+            return None
+        xs += positions.x
+        ys += positions.y
+        best = numpy.argmin((xs - target[0]) ** 2 + (ys - target[1]) ** 2)
+        return int(xs[best]), int(ys[best])
+
+    def find_free(self, sprite, canvas, start, center):
+        """
+        Returns (position, inside). Prefers positions keeping the tag
+        rect inside the canvas, closest to start. If there are none, the
+        free position around the canvas closest to center.
+        """
+        glyph = self._glyph(sprite)
+        rw, rh = sprite.rect.size
+        if canvas.w >= rw and canvas.h >= rh:
+            position = self._nearest_free(
+                glyph, Rect(canvas.x, canvas.y,
+                            canvas.w - rw + 1, canvas.h - rh + 1), start)
+            if position is not None:
+                return position, True
+        around = canvas
+        if self.grid is not None:
+            around = around.union(Rect(self.origin, self.grid.shape))
+        around = around.inflate(4 * glyph.shape[0], 4 * glyph.shape[1])
+        return self._nearest_free(glyph, around, center), False
 
 
 def _get_tags_bounding(tag_store):
@@ -209,18 +1048,19 @@ def _get_group_bounding(tag_store, sizeRect):
     return sizeRect
 
 
-def _archimedean_spiral(reverse):
+def _archimedean_spiral(reverse, step_size=STEP_SIZE, radius=RADIUS,
+                        eccentricity=ECCENTRICITY):
     DEFAULT_STEP = 0.05  # radians
     t = 0
     r = 1
     if reverse:
         r = -1
     while True:
-        t += DEFAULT_STEP * STEP_SIZE * r
-        yield (ECCENTRICITY * RADIUS * t * cos(t), RADIUS * t * sin(t))
+        t += DEFAULT_STEP * step_size * r
+        yield (eccentricity * radius * t * cos(t), radius * t * sin(t))
 
 
-def _rectangular_spiral(reverse):
+def _rectangular_spiral(reverse, step_size=STEP_SIZE):
     DEFAULT_STEP = 3  # px
     directions = [(1, 0), (0, 1), (-1, 0), (0, -1)]
     if reverse:
@@ -233,35 +1073,132 @@ def _rectangular_spiral(reverse):
         for step in range(spl * 2):
             if step == spl:
                 direction = directions[(spl - 1) % 4]
-            dx += direction[0] * STEP_SIZE * DEFAULT_STEP
-            dy += direction[1] * STEP_SIZE * DEFAULT_STEP
+            dx += direction[0] * step_size * DEFAULT_STEP
+            dy += direction[1] * step_size * DEFAULT_STEP
             yield dx, dy
         spl += 1
 
 
-def _search_place(current_tag, tag_store, canvas, spiral, ratio):
+class _SpiralTable(object):
+    """
+    Integer offsets of a spiral, rounded with round() (halves to even,
+    where Rect rounds them away from zero) and with consecutive duplicates
+    dropped. Computed in chunks as far as a search has needed so far, and
+    shared by all later searches, in any thread.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.chunks = []
+        self.last = None
+        self.lock = threading.Lock()
+
+    def _extend(self):
+        chunk = []
+        last = self.last
+        for dx, dy in self.steps:
+            offset = (int(round(dx)), int(round(dy)))
+            if offset != last:
+                chunk.append(offset)
+                last = offset
+                if len(chunk) == SPIRAL_CHUNK:
+                    break
+        self.last = last
+        self.chunks.append(chunk)
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i == len(self.chunks):
+                with self.lock:
+                    if i == len(self.chunks):
+                        self._extend()
+            yield from self.chunks[i]
+            i += 1
+
+
+SPIRAL_TABLES = {}
+SPIRAL_TABLES_LOCK = threading.Lock()
+
+
+def _spiral_table(spiral, reverse, *params):
+    key = (spiral, reverse) + params
+    with SPIRAL_TABLES_LOCK:
+        if key not in SPIRAL_TABLES:
+            SPIRAL_TABLES[key] = _SpiralTable(spiral(reverse, *params))
+        return SPIRAL_TABLES[key]
+
+
+def _add_tag(current_tag, tag_store, index, bounding):
+    """
+    Add a placed tag, growing bounding (the tag_store bounding rect) with it
+    """
+    if len(tag_store):
+        bounding.union_ip(current_tag.rect)
+    else:
+        bounding.update(current_tag.rect)
+    tag_store.add(current_tag)
+    index.add(current_tag)
+
+
+def _search_place(current_tag, tag_store, canvas, spiral, ratio, index=None,
+                  rng=random, max_steps=None, deadline=None, bounding=None):
     """
     Start a spiral search with random direction.
     Resize the canvas if the spiral exceeds the bounding rectangle
+    spiral(reverse) gives the integer offsets to try
+    index, if given, is kept in sync with tag_store and used for collisions
+    bounding, if given, is kept the bounding rect of tag_store
+    After max_steps steps or past the deadline (a time.time()) the tag
+    takes the free spot found nearest the centre outside the canvas,
+    growing it, or if there is none gives up, returning False; returns
+    True once the tag is placed
     """
 
-    reverse = choice((0, 1))
+    if index is None:
+        index = _SpatialIndex()
+        index.rebuild(tag_store)
+    if bounding is None:
+        bounding = _get_tags_bounding(tag_store)
+
+    reverse = rng.choice((0, 1))
     start_x = current_tag.rect.x
     start_y = current_tag.rect.y
     min_dist = None
     opt_x = opt_y = 0
 
-    current_bounding = _get_tags_bounding(tag_store)
-    cx = current_bounding.w / 2.0
-    cy = current_bounding.h / 2.0
+    # the canvas moves when it grows, the tags stay put
+    cx = canvas.x + bounding.w / 2.0
+    cy = canvas.y + bounding.h / 2.0
+
+    for steps, (dx, dy) in enumerate(spiral(reverse)):
+        if steps == max_steps or deadline is not None and \
+           not steps % DEADLINE_STEPS and time.time() > deadline:
+            if min_dist is None:
+                return False
+            # out of budget, take the free spot found outside the canvas
+            current_tag.rect.x = opt_x
+            current_tag.rect.y = opt_y
+            _grow_canvas(current_tag, tag_store, canvas, ratio, index,
+                         bounding)
+            return True
+        if steps == index.spiral_steps:
+            position, inside = index.find_free(current_tag, canvas,
+                                               (start_x, start_y), (cx, cy))
+            current_tag.rect.topleft = position
+            if inside:
+                _add_tag(current_tag, tag_store, index, bounding)
+            else:
+                _grow_canvas(current_tag, tag_store, canvas, ratio, index,
+                             bounding)
+            return True
 
-    for dx, dy in spiral(reverse):
         current_tag.rect.x = start_x + dx
         current_tag.rect.y = start_y + dy
-        if not _do_collide(current_tag, tag_store):
+        if not index.collide(current_tag):
             if canvas.contains(current_tag.rect):
-                tag_store.add(current_tag)
-                return
+                _add_tag(current_tag, tag_store, index, bounding)
+                return True
             else:
                 # get the distance from center
                 current_dist = (abs(cx - current_tag.rect.x) ** 2 +
@@ -276,122 +1213,525 @@ def _search_place(current_tag, tag_store, canvas, spiral, ratio):
                    abs(dy) > canvas.height / 2.0:
                     current_tag.rect.x = opt_x
                     current_tag.rect.y = opt_y
-                    tag_store.add(current_tag)
-
-                    new_bounding = current_bounding.union(current_tag.rect)
+                    _grow_canvas(current_tag, tag_store, canvas, ratio, index,
+                                 bounding)
+                    return True
 
-                    delta_x = delta_y = 0.0
-                    if new_bounding.w > canvas.width:
-                        delta_x = new_bounding.w - canvas.width
-
-                        canvas.width = new_bounding.w
-                        delta_y = ratio * new_bounding.w - canvas.height
-                        canvas.height = ratio * new_bounding.w
-
-                    if new_bounding.h > canvas.height:
-                        delta_y = new_bounding.h - canvas.height
-
-                        canvas.height = new_bounding.h
-                        canvas.width = new_bounding.h / ratio
-                        delta_x = canvas.width - canvas.width
-
-                    # realign
-                    for tag in tag_store:
-                        tag.rect.x += delta_x / 2.0
-                        tag.rect.y += delta_y / 2.0
-
-                    canvas = _get_tags_bounding(tag_store)
-                    return
 
+def _grow_canvas(current_tag, tag_store, canvas, ratio, index, bounding):
+    """
+    Add a tag placed outside the canvas, grow the canvas to keep the
+    ratio and recentre it on the tags
+    """
+    new_bounding = bounding.union(current_tag.rect)
+    _add_tag(current_tag, tag_store, index, bounding)
 
-def _draw_cloud(tag_list,
-                layout=LAYOUT_MIX,
-                size=(500, 500),
-                fontname=DEFAULT_FONT,
-                rectangular=False):
+    delta_x = delta_y = 0.0
+    if new_bounding.w > canvas.width:
+        delta_x = new_bounding.w - canvas.width
 
-    # sort the tags by size and word length
-    tag_list.sort(key=lambda tag: len(tag['tag']))
-    tag_list.sort(key=lambda tag: tag['size'])
-    tag_list.reverse()
+        canvas.width = new_bounding.w
+        delta_y = ratio * new_bounding.w - canvas.height
+        canvas.height = ratio * new_bounding.w
 
-    # create the tag space
-    tag_sprites = []
-    area = 0
-    for tag in tag_list:
-        tag_sprite = Tag(tag, (0, 0), fontname=fontname)
-        area += tag_sprite.mask.count()
-        tag_sprites.append(tag_sprite)
+    if new_bounding.h > canvas.height:
+        delta_y = new_bounding.h - canvas.height
 
-    canvas = Rect(0, 0, 0, 0)
-    ratio = float(size[1]) / size[0]
-
-    if rectangular:
-        spiral = _rectangular_spiral
-    else:
-        spiral = _archimedean_spiral
-
-    aligned_tags = Group()
-    for tag_sprite in tag_sprites:
-        angle = 0
-        if layout == LAYOUT_MIX and randint(0, 1) == 0:
-            angle = 90
-        elif layout == LAYOUT_VERTICAL:
-            angle = 90
-        elif layout == LAYOUT_FORTYFIVE:
-            if randint(0, 1) == 0:
-                angle = 45
-            else:
-                angle = 315
-        elif layout == LAYOUT_RANDOM:
-            angle = randint(0, 89)
+        canvas.height = new_bounding.h
+        canvas.width = new_bounding.h / ratio
+        delta_x = canvas.width - canvas.width
 
-        tag_sprite.rotate(angle)
+    # realign, the tags are moved to the canvas once the layout is done
+    canvas.x -= delta_x / 2.0
+    canvas.y -= delta_y / 2.0
 
-        xpos = canvas.width - tag_sprite.rect.width
-        if xpos < 0:
-            xpos = 0
-        xpos = randint(int(xpos * LOWER_START), int(xpos * UPPER_START))
-        tag_sprite.rect.x = xpos
 
-        ypos = canvas.height - tag_sprite.rect.height
-        if ypos < 0:
-            ypos = 0
-        ypos = randint(int(ypos * LOWER_START), int(ypos * UPPER_START))
-        tag_sprite.rect.y = ypos
+def _score_layout(aligned_tags, size, dropped=0):
+    """
+    Fewer dropped tags, then the zoom the layout gets to fill size, then
+    the smaller bounding area; higher is better
+    """
+    canvas = _get_tags_bounding(aligned_tags)
+    return (-dropped,
+            min(float(size[0]) / canvas.w, float(size[1]) / canvas.h),
+            -canvas.w * canvas.h)
 
-        _search_place(tag_sprite, aligned_tags, canvas, spiral, ratio)
 
-    canvas = _get_tags_bounding(aligned_tags)
+def _layout_worker(args):
+    """
+    Lay out in a worker process. Returns the score, in placement order
+    the (tag index, size, angle, x, y, w, h) of every placed tag, and the
+    stats with the dropped tags as indices
+    """
+    config, tag_list, deadline = args
+    if not font.get_init():
+        font.init()
+    stats = {}
+    cloud = CloudLayout(**config)
+    placements = cloud.place(tag_list, stats=stats, deadline=deadline)
+    dropped = set(id(tag) for tag in stats['dropped'])
+    stats['dropped'] = [i for i, tag in enumerate(tag_list)
+                        if id(tag) in dropped]
+    # the placed tags went in in tag list order
+    placed = [i for i, tag in enumerate(tag_list) if id(tag) not in dropped]
+    records = [(i, p.size, p.angle) + tuple(p.rect)
+               for i, p in zip(placed, placements)]
+    return (_score_layout(placements, cloud.size, len(dropped)),
+            records, stats)
+
+
+def _other_angle(layout, angle):
+    """
+    The angle a tag placed at angle is retried at: the other orientation
+    of the layout, never upside down
+    """
+    if layout == LAYOUT_MIX:
+        return 0 if angle == 90 else 90
+    elif layout == LAYOUT_FORTYFIVE:
+        return 45 if angle == 315 else 315
+    # LAYOUT_RANDOM picks from 0 to 89, turn the other way
+    return (angle - 90) % 360
 
-    # resize cloud
-    zoom = min(float(size[0]) / canvas.w, float(size[1]) / canvas.h)
 
-    logging.debug('zoom {}'.format(zoom))
-    cw = int(canvas.w * zoom)
-    ch = int(canvas.h * zoom)
+class CloudLayout(object):
+    """
+    Lays out tag clouds. A CloudLayout has its own configuration and random
+    generator, and every layout its own collision state, so clouds can be
+    laid out in several threads at once, with a CloudLayout each. The
+    font, glyph and spiral caches they share are locked.
+    seed is a number or a random.Random, None uses the random module; the
+    same tags and seed give the same layout. The spiral and start
+    parameters default to the module constants.
+    The words are laid out at layout_scale times their size, then zoomed
+    to fill size and drawn at the zoomed size: below 1 the layout is a
+    cheaper proxy of the output, with smaller glyphs, masks and canvas;
+    the padding between words shrinks with it.
+    With best_of > 1, that many layouts are tried in a pool of workers
+    processes and the one filling size best is kept. Otherwise workers > 1
+    renders the words in a pool while the biggest are already placed.
+    A tag that doesn't fit within max_steps spiral steps is retried rotated
+    or smaller, then dropped, as are the tags left after timeout seconds.
+    """
 
-    for tag in aligned_tags:
-        tag.rect.x *= zoom
-        tag.rect.y *= zoom
-        tag.rect.width *= zoom
-        tag.rect.height *= zoom
+    def __init__(self,
+                 layout=LAYOUT_MIX,
+                 size=(500, 500),
+                 fontname=DEFAULT_FONT,
+                 rectangular=False,
+                 engine=ENGINE_SPRITES,
+                 seed=None,
+                 best_of=1,
+                 workers=None,
+                 max_steps=None,
+                 timeout=None,
+                 step_size=None,
+                 radius=None,
+                 eccentricity=None,
+                 lower_start=None,
+                 upper_start=None,
+                 layout_scale=None):
+        self.layout = layout
+        self.size = size
+        self.fontname = fontname
+        self.rectangular = rectangular
+        if engine == ENGINE_CORRELATION and numpy is None:
+            logging.warning('numpy not available, using the occupancy engine')
+            engine = ENGINE_OCCUPANCY
+        self.engine = engine
+        self.rng = _get_rng(seed)
+        self.best_of = best_of
+        self.workers = workers
+        self.max_steps = max_steps
+        self.timeout = timeout
+        self.step_size = STEP_SIZE if step_size is None else step_size
+        self.radius = RADIUS if radius is None else radius
+        self.eccentricity = ECCENTRICITY if eccentricity is None \
+            else eccentricity
+        self.lower_start = LOWER_START if lower_start is None \
+            else lower_start
+        self.upper_start = UPPER_START if upper_start is None \
+            else upper_start
+        self.layout_scale = LAYOUT_SCALE if layout_scale is None \
+            else layout_scale
+
+    def _config(self, seed):
+        """
+        What a worker process needs to repeat this layout with seed
+        """
+        return dict(layout=self.layout, size=self.size,
+                    fontname=self.fontname, rectangular=self.rectangular,
+                    engine=self.engine, seed=seed, max_steps=self.max_steps,
+                    step_size=self.step_size, radius=self.radius,
+                    eccentricity=self.eccentricity,
+                    lower_start=self.lower_start,
+                    upper_start=self.upper_start,
+                    layout_scale=self.layout_scale)
+
+    def _padding(self):
+        """
+        TAG_PADDING at layout_scale, the words are zoomed back after.
+        Rounded up: a small glyph's hinted ink is up to a pixel off the
+        zoomed full size one, less padding lets the drawn words touch
+        """
+        return max(1, int(ceil(TAG_PADDING * self.layout_scale)))
+
+    def _spiral(self, reverse):
+        if self.rectangular:
+            return _spiral_table(_rectangular_spiral, reverse, self.step_size)
+        return _spiral_table(_archimedean_spiral, reverse, self.step_size,
+                             self.radius, self.eccentricity)
+
+    def _index(self):
+        if self.engine == ENGINE_CORRELATION:
+            return _CorrelationIndex()
+        elif self.engine == ENGINE_OCCUPANCY:
+            return _OccupancyMask()
+        return _SpatialIndex()
+
+    def _deadline(self):
+        if self.timeout is None:
+            return None
+        return time.time() + self.timeout
+
+    def place(self, tag_list, progress=None, stats=None, deadline=None):
+        """
+        Place the tags of a sorted tag list, returns their Placements.
+        progress(placed, total) is called after each tag. A tag not placed
+        within max_steps spiral steps is retried rotated (in layouts that
+        rotate), then smaller, then dropped. Past the deadline (a
+        time.time(), by default timeout from now) the remaining tags are
+        dropped without being rendered. stats, if given, is filled with
+        how many tags were placed, rotated and shrunk, and the dropped
+        tags.
+        """
+        rng = self.rng
+        layout = self.layout
+        if deadline is None:
+            deadline = self._deadline()
+
+        padding = self._padding()
+        if self.workers is not None and self.workers > 1:
+            tags = _prepare_glyphs(tag_list, self.fontname, self.workers,
+                                   padding)
+        else:
+            tags = tag_list
+
+        canvas = Rect(0, 0, 0, 0)
+        ratio = float(self.size[1]) / self.size[0]
+
+        aligned_tags = Group()
+        index = self._index()
+        if stats is None:
+            stats = {}
+        stats.update(placed=0, rotated=0, shrunk=0, dropped=[])
+        retries = ['placed']
+        if layout in (LAYOUT_MIX, LAYOUT_FORTYFIVE, LAYOUT_RANDOM):
+            retries.append('rotated')
+        retries.append('shrunk')
+        bounding = Rect(0, 0, 0, 0)
+        placements = []
+        for placed, tag in enumerate(tags, 1):
+            if len(aligned_tags) and deadline is not None and \
+               time.time() > deadline:
+                # out of time, the rest would only be rendered to fail
+                stats['dropped'].extend(tag_list[placed - 1:])
+                if tags is not tag_list:
+                    tags.close()
+                if progress is not None:
+                    progress(len(tag_list), len(tag_list))
+                break
+            tag_sprite = Tag(tag, (0, 0), fontname=self.fontname,
+                             padding=padding)
+            angle = 0
+            if layout == LAYOUT_MIX and rng.randint(0, 1) == 0:
+                angle = 90
+            elif layout == LAYOUT_VERTICAL:
+                angle = 90
+            elif layout == LAYOUT_FORTYFIVE:
+                if rng.randint(0, 1) == 0:
+                    angle = 45
+                else:
+                    angle = 315
+            elif layout == LAYOUT_RANDOM:
+                angle = rng.randint(0, 89)
+
+            tag_sprite.rotate(angle)
+
+            xpos = canvas.width - tag_sprite.rect.width
+            if xpos < 0:
+                xpos = 0
+            xpos = rng.randint(int(xpos * self.lower_start),
+                               int(xpos * self.upper_start))
+            tag_sprite.rect.x = canvas.x + xpos
+
+            ypos = canvas.height - tag_sprite.rect.height
+            if ypos < 0:
+                ypos = 0
+            ypos = rng.randint(int(ypos * self.lower_start),
+                               int(ypos * self.upper_start))
+            tag_sprite.rect.y = canvas.y + ypos
+
+            start = tag_sprite.rect.topleft
+            if not len(aligned_tags):
+                # the first tag always fits, and the cloud can't be empty
+                budget = (None, None)
+            else:
+                budget = (self.max_steps, deadline)
+            for outcome in retries:
+                if outcome == 'rotated':
+                    other = _other_angle(layout, angle)
+                    tag_sprite.rotate(other - tag_sprite.rotation)
+                elif outcome == 'shrunk':
+                    tag_sprite.rotate(angle - tag_sprite.rotation)
+                    size = int(tag_sprite.tag['size'] * SHRINK_FACTOR)
+                    if size < 1:
+                        break
+                    tag_sprite.resize(size)
+                tag_sprite.rect.topleft = start
+                if _search_place(tag_sprite, aligned_tags, canvas,
+                                 self._spiral, ratio, index, rng, *budget,
+                                 bounding=bounding):
+                    stats[outcome] += 1
+                    break
+                if deadline is not None and time.time() > deadline:
+                    break
+            if not tag_sprite.alive():
+                stats['dropped'].append(tag)
+            else:
+                placements.append(Placement.from_tag(tag_sprite))
+                if not index.keeps_sprites:
+                    tag_sprite.release()
+            if progress is not None:
+                progress(placed, len(tag_list))
+
+        # into canvas coordinates
+        for placement in placements:
+            placement.rect.move_ip(-canvas.x, -canvas.y)
+        return placements
+
+    def _place_best(self, tag_list, progress=None, stats=None):
+        """
+        Run best_of independently seeded layouts in a process pool and
+        keep the Placements of the best scoring one. progress counts the
+        tags of every layout and is called as each layout finishes
+        """
+        deadline = self._deadline()
+        seeds = [self.rng.randint(0, 2 ** 32 - 1)
+                 for i in range(self.best_of)]
+        jobs = [(self._config(s), tag_list, deadline) for s in seeds]
+        with ProcessPoolExecutor(self.workers) as pool:
+            results = []
+            for result in pool.map(_layout_worker, jobs):
+                results.append(result)
+                if progress is not None:
+                    progress(len(results) * len(tag_list),
+                             self.best_of * len(tag_list))
+        score, records, best_stats = max(results,
+                                         key=lambda result: result[0])
+        logging.debug('best of {} layouts, zoom {}'.format(self.best_of,
+                                                           score[1]))
+        if stats is not None:
+            stats.update(best_stats,
+                         dropped=[tag_list[i] for i in best_stats['dropped']])
+
+        return [Placement(tag_list[i]['tag'], tag_size, angle,
+                          Rect(x, y, w, h), tag_list[i]['color'])
+                for i, tag_size, angle, x, y, w, h in records]
+
+    def draw(self, tag_list, progress=None, stats=None):
+        """
+        Sort tag_list, lay it out at layout_scale and zoom it to fill
+        size. Returns the canvas rect and the Placements, at the zoomed
+        size
+        """
+        size = self.size
+
+        # sort the tags by size and word length
+        tag_list.sort(key=lambda tag: len(tag['tag']))
+        tag_list.sort(key=lambda tag: tag['size'])
+        tag_list.reverse()
+
+        layout_tags = tag_list
+        if self.layout_scale != 1:
+            layout_tags = []
+            for tag in tag_list:
+                layout_size = int(tag['size'] * self.layout_scale + 0.5)
+                layout_tags.append(dict(tag, size=max(1, layout_size)))
+
+        if self.best_of > 1:
+            placements = self._place_best(layout_tags, progress, stats)
+        else:
+            placements = self.place(layout_tags, progress, stats)
+
+        if layout_tags is not tag_list and stats is not None:
+            proxies = dict((id(proxy), tag)
+                           for proxy, tag in zip(layout_tags, tag_list))
+            stats['dropped'] = [proxies[id(tag)] for tag in stats['dropped']]
+
+        canvas = _get_tags_bounding(placements)
+
+        # resize cloud
+        zoom = min(float(size[0]) / canvas.w, float(size[1]) / canvas.h)
+
+        logging.debug('zoom {}'.format(zoom))
+        cw = int(canvas.w * zoom)
+        ch = int(canvas.h * zoom)
+
+        for placement in placements:
+            rect = placement.rect
+            rect.x *= zoom
+            rect.y *= zoom
+            rect.width *= zoom
+            rect.height *= zoom
+
+            if rect.x + rect.width > cw:
+                rect.x = cw - rect.width
+            if rect.y + rect.height > ch:
+                rect.y = ch - rect.height
+
+            placement.size = int(placement.size * zoom)
+
+        canvas = _get_tags_bounding(placements)
+
+        padding = 160
+        canvas.width += padding
+        canvas.height += padding
+
+        return canvas, placements
+
+    def create_tag_image(self, tags, output, background=(255, 255, 255),
+                         progress=None, stats=None):
+        """
+        Lay out tags and save them as a png, output is a path or a binary
+        file. progress and stats as for place()
+        """
+
+        if not len(tags):
+            return
+
+        with pygame_session:
+            sizeRect, placements = self.draw(tags, progress, stats)
+
+            # the cloud takes 90% of the image, with a 5% margin; every word
+            # is drawn there at its final size, in a single pass
+            scale = 0.9
+            xo = int(sizeRect.w * 0.05)
+            yo = int(sizeRect.h * 0.05)
+            ttf = load_font(self.fontname)['ttf']
+            output_surface = Surface((sizeRect.w, sizeRect.h), SRCALPHA, 32)
+            output_surface.fill(background)
+            for placement in placements:
+                if int(placement.size * scale) > 0:
+                    output_surface.blit(placement.render(ttf, scale),
+                                        (xo + int(placement.rect.x * scale),
+                                         yo + int(placement.rect.y * scale)))
+            if isinstance(output, str):
+                pygame.image.save(output_surface, output)
+            else:
+                pygame.image.save(output_surface, output, 'png')
+
+    def create_svg(self, tags, output, background=(255, 255, 255),
+                   progress=None, stats=None):
+        """
+        Lay out tags and save them as an svg, output is a path or a binary
+        file. The words are text elements in the font, imported from its
+        web address. progress and stats as for place()
+        """
+
+        if not len(tags):
+            return
+
+        with pygame_session:
+            sizeRect, placements = self.draw(tags, progress, stats)
+
+            # the same 90% and 5% margin as the png
+            font_spec = load_font(self.fontname)
+            lines = [
+                '<?xml version="1.0" encoding="UTF-8"?>',
+                '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" '
+                'height="{1}" viewBox="0 0 {0} {1}">'.format(sizeRect.w,
+                                                             sizeRect.h)]
+            if font_spec.get('web'):
+                lines.append('<style>@import url("{}");</style>'.format(
+                    escape(font_spec['web'])))
+            lines.append('<rect width="100%" height="100%" fill="{}"/>'.format(
+                _hex_color(background)))
+            lines.append('<g font-family={} transform="translate({} {}) '
+                         'scale(0.9)">'.format(
+                             quoteattr("'{}'".format(font_spec['name'])),
+                             int(sizeRect.w * 0.05), int(sizeRect.h * 0.05)))
+            for placement in placements:
+                if placement.size > 0:
+                    lines.append(placement.svg_text(font_spec['ttf']))
+            lines.append('</g>')
+            lines.append('</svg>')
+
+            data = '\n'.join(lines).encode('utf-8') + b'\n'
+            if isinstance(output, str):
+                with open(output, 'wb') as svg_file:
+                    svg_file.write(data)
+            else:
+                output.write(data)
 
-        if tag.rect.x + tag.rect.width > cw:
-            tag.rect.x = cw - tag.rect.width
-        if tag.rect.y + tag.rect.height > ch:
-            tag.rect.y = ch - tag.rect.height
+    def create_html_data(self, tags, progress=None, stats=None):
+        """
+        Lay out tags, returns data structures to be used for HTML tag
+        clouds
+        """
 
-        tag.tag['size'] = int(tag.tag['size'] * zoom)
-        tag.update_fontsize()
+        if not len(tags):
+            return
 
-    canvas = _get_tags_bounding(aligned_tags)
+        sizeRect, placements = self.draw(tags, progress, stats)
 
-    padding = 160
-    canvas.width += padding
-    canvas.height += padding
+        ttf = load_font(self.fontname)['ttf']
+        placements = sorted(placements, key=lambda placement: placement.size)
+        placements.reverse()
+        data = {
+            'css': {},
+            'links': []
+        }
 
-    return canvas, aligned_tags
+        color_map = {}
+        for color_index, tag in enumerate(tags):
+            if not tag['color'] in color_map:
+                color_name = 'c{}'.format(color_index)
+                hslcolor = colorsys.rgb_to_hls(tag['color'][0] / 255.0,
+                                               tag['color'][1] / 255.0,
+                                               tag['color'][2] / 255.0)
+                lighter = hslcolor[1] * 1.4
+                if lighter > 1:
+                    lighter = 1
+                light = colorsys.hls_to_rgb(hslcolor[0], lighter, hslcolor[2])
+                data['css'][color_name] = ('#%02x%02x%02x' % tag['color'],
+                                           '#%02x%02x%02x' % (light[0] * 255,
+                                                              light[1] * 255,
+                                                              light[2] * 255))
+                color_map[tag['color']] = color_name
+
+        for placement in placements:
+            line_offset = 0
+
+            tag_font = font_cache.get(ttf, placement.size)
+            line_offset = tag_font.get_linesize() - \
+                (tag_font.get_ascent() + abs(tag_font.get_descent()) -
+                 placement.rect.height) - 4
+
+            tag = {
+                'tag': placement.word,
+                'cls': color_map[placement.color],
+                'top': placement.rect.y - sizeRect.y,
+                'left': placement.rect.x - sizeRect.x,
+                'size': int(placement.size * 0.85),
+                'height': int(placement.rect.height * 1.19) + 4,
+                'width': placement.rect.width,
+                'lh': line_offset
+            }
+
+            data['links'].append(tag)
+            data['size'] = (sizeRect.w, sizeRect.h * 1.15)
+
+        return data
 
 
 def create_tag_image(
@@ -401,101 +1741,88 @@ def create_tag_image(
         background=(255, 255, 255),
         layout=LAYOUT_MIX,
         fontname=DEFAULT_FONT,
-        rectangular=False):
+        rectangular=False,
+        engine=ENGINE_SPRITES,
+        seed=None,
+        best_of=1,
+        workers=None,
+        progress=None,
+        max_steps=None,
+        timeout=None,
+        stats=None,
+        layout_scale=None):
     """
-    Create a png tag cloud image
+    Create a png tag cloud image, output is a path or a binary file.
+    The same tags and seed (a number or a random.Random) give the same
+    image.
+    With best_of > 1, that many layouts are tried in a pool of workers
+    processes and the one filling size best is drawn. Otherwise workers > 1
+    renders the words in a pool while the biggest are already placed.
+    progress(placed, total) is called as the tags are placed.
+    A tag that doesn't fit within max_steps spiral steps is retried rotated
+    or smaller, then dropped, as are the tags left after timeout seconds.
+    stats, a dict, gets the placed, rotated and shrunk counts and the
+    dropped tags.
+    layout_scale below 1 lays the words out smaller, which is cheaper, and
+    only draws them at the output size.
     """
 
-    if not len(tags):
-        return
-
-    pygame.init()
-
-    sizeRect, tag_store = _draw_cloud(tags,
-                                      layout,
-                                      size=size,
-                                      fontname=fontname,
-                                      rectangular=rectangular)
-
-    tag_surface = Surface((sizeRect.w, sizeRect.h), SRCALPHA, 32)
-    tag_surface.fill(background)
-    for tag in tag_store:
-        tag_surface.blit(tag.image, tag.rect)
-    tag_surface = pygame.transform.scale(tag_surface,
-                                         (int(sizeRect.w * 0.9),
-                                          int(sizeRect.h * 0.9)))
-
-    xo = int(sizeRect.w * 0.05)
-    yo = int(sizeRect.h * 0.05)
-    output_surface = Surface((sizeRect.w, sizeRect.h), SRCALPHA, 32)
-    output_surface.fill(background)
-    output_surface.blit(tag_surface, (xo, yo))
-    pygame.image.save(output_surface, output)
+    cloud = CloudLayout(layout, size, fontname, rectangular, engine, seed,
+                        best_of, workers, max_steps, timeout,
+                        layout_scale=layout_scale)
+    return cloud.create_tag_image(tags, output, background, progress, stats)
+
+
+def create_svg(tags,
+               output,
+               size=(1024, 768),
+               background=(255, 255, 255),
+               layout=LAYOUT_MIX,
+               fontname=DEFAULT_FONT,
+               rectangular=False,
+               engine=ENGINE_SPRITES,
+               seed=None,
+               best_of=1,
+               workers=None,
+               progress=None,
+               max_steps=None,
+               timeout=None,
+               stats=None,
+               layout_scale=None):
+    """
+    Create an svg tag cloud, output is a path or a binary file. The words
+    are text elements, so the size of the file and the time to write it
+    don't depend on size. The other arguments as for create_tag_image.
+    """
 
-    pygame.quit()
+    cloud = CloudLayout(layout, size, fontname, rectangular, engine, seed,
+                        best_of, workers, max_steps, timeout,
+                        layout_scale=layout_scale)
+    return cloud.create_svg(tags, output, background, progress, stats)
 
 
 def create_html_data(tags,
                      size=(1024, 768),
                      layout=LAYOUT_MIX,
                      fontname=DEFAULT_FONT,
-                     rectangular=False):
+                     rectangular=False,
+                     engine=ENGINE_SPRITES,
+                     seed=None,
+                     best_of=1,
+                     workers=None,
+                     progress=None,
+                     max_steps=None,
+                     timeout=None,
+                     stats=None,
+                     layout_scale=None):
     """
     Create data structures to be used for HTML tag clouds.
+    The same tags and seed give the same layout. best_of, workers,
+    progress, max_steps, timeout, stats and layout_scale as for
+    create_tag_image.
     """
 
-    if not len(tags):
-        return
-
-    sizeRect, tag_store = _draw_cloud(tags,
-                                      layout,
-                                      size=size,
-                                      fontname=fontname,
-                                      rectangular=rectangular)
-
-    tag_store = sorted(tag_store, key=lambda tag: tag.tag['size'])
-    tag_store.reverse()
-    data = {
-        'css': {},
-        'links': []
-    }
-
-    color_map = {}
-    for color_index, tag in enumerate(tags):
-        if not tag['color'] in color_map:
-            color_name = 'c{}'.format(color_index)
-            hslcolor = colorsys.rgb_to_hls(tag['color'][0] / 255.0,
-                                           tag['color'][1] / 255.0,
-                                           tag['color'][2] / 255.0)
-            lighter = hslcolor[1] * 1.4
-            if lighter > 1:
-                lighter = 1
-            light = colorsys.hls_to_rgb(hslcolor[0], lighter, hslcolor[2])
-            data['css'][color_name] = ('#%02x%02x%02x' % tag['color'],
-                                       '#%02x%02x%02x' % (light[0] * 255,
-                                                          light[1] * 255,
-                                                          light[2] * 255))
-            color_map[tag['color']] = color_name
-
-    for stag in tag_store:
-        line_offset = 0
-
-        line_offset = stag.font.get_linesize() - \
-            (stag.font.get_ascent() + abs(stag.font.get_descent()) -
-             stag.rect.height) - 4
-
-        tag = {
-            'tag': stag.tag['tag'],
-            'cls': color_map[stag.tag['color']],
-            'top': stag.rect.y - sizeRect.y,
-            'left': stag.rect.x - sizeRect.x,
-            'size': int(stag.tag['size'] * 0.85),
-            'height': int(stag.rect.height * 1.19) + 4,
-            'width': stag.rect.width,
-            'lh': line_offset
-        }
-
-        data['links'].append(tag)
-        data['size'] = (sizeRect.w, sizeRect.h * 1.15)
-
-    return data
+    cloud = CloudLayout(layout, size, fontname, rectangular, engine, seed,
+                        best_of, workers, max_steps, timeout,
+                        layout_scale=layout_scale)
+    return cloud.create_html_data(tags, progress, stats)
@@ -1,38 +1,73 @@
 # -*- coding: utf-8 -*-
 import re
+import codecs
+from collections import Counter
 from pytagcloud.lang.stopwords import StopWords
 from operator import itemgetter
 import logging
 
-def get_tag_counts(text):
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+CHUNK_SIZE = 1024 * 1024  # characters (or bytes) read at a time
+
+
+def _chunks(stream, size):
+    if hasattr(stream, 'read'):
+        while True:
+            chunk = stream.read(size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in stream:
+            yield chunk
+
+
+def _word_tail(text):
+    """
+    Start of the word running to the end of text, len(text) if none.
+    Scans backwards, \\w is isalnum() or '_'
+    """
+    i = len(text)
+    while i and (text[i - 1].isalnum() or text[i - 1] == '_'):
+        i -= 1
+    return i
+
+
+def get_tag_counts(text, stop_words=None):
     """
     Search tags in a given text. The language detection is based on stop lists.
     This implementation is inspired by https://github.com/jdf/cue.language. Thanks Jonathan Feinberg.
+    A long running caller can pass its StopWords to skip reloading the lists.
+    """
+    return get_stream_tag_counts([str(text)], stop_words)
+
+
+def get_stream_tag_counts(stream, stop_words=None, chunk_size=CHUNK_SIZE):
     """
-    text = str(text)
-    words = re.findall(r'\w+', text, re.UNICODE)
-
-    # Workaround because the regex mangled the unicode
-    # _PUNCTUATION = u'.,<>;:/?\\\"\'-_+=!@\#$%^&*()'
-    # words = text.split()
-    # words = map(lambda x:x.lower(), words)
-    # words = map(lambda x:unicode(x, 'UTF-8'), words)
-    # words = map(lambda x: x.translate(dict.fromkeys(map(ord, _PUNCTUATION))),
-    #             words)
-
-    s = StopWords()
-    s.load_language(s.guess(words))
-    
-    counted = {}
-    
-    for word in words:
-        if not s.is_stop_word(word) and len(word) >= 1:
-            if word in counted:
-                counted[word] += 1
-            else: 
-                counted[word] = 1
-      
-    if len(list(counted.keys())) == 0:
+    get_tag_counts for a file object or an iterable of text chunks, str or
+    utf-8 bytes. Memory use grows with the vocabulary, not the text.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    counted = Counter()
+    tail = ''
+    for chunk in _chunks(stream, chunk_size):
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        text = tail + chunk
+        # hold back the last word, the next chunk may continue it
+        cut = _word_tail(text)
+        counted.update(WORD_RE.findall(text, 0, cut))
+        tail = text[cut:]
+    counted.update(WORD_RE.findall(tail + decoder.decode(b'', True)))
+
+    s = stop_words if stop_words is not None else StopWords()
+    s.load_language(s.guess(counted))
+
+    for word in list(counted):
+        if s.is_stop_word(word):
+            del counted[word]
+
+    if len(counted) == 0:
         return None
     else:
         return sorted(iter(counted.items()), key=itemgetter(1), reverse=True)
@@ -4,46 +4,63 @@ import os
 # ACTIVE_LISTS = ('german', 'french', 'italian', 'english', 'spanish')
 ACTIVE_LISTS = ('english', 'spanish')
 
+STOP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stop')
+
+# language -> frozenset of casefolded stop words, shared by the process
+_stop_words_lists = {}
+
+
+def load_stop_words(language):
+    """
+    The stop words of a language, read from the stop directory the first
+    time it is asked for
+    """
+    if language not in _stop_words_lists:
+        with open(os.path.join(STOP_DIR, language), 'r') as stop_file:
+            _stop_words_lists[language] = frozenset(
+                stop_word.strip().casefold() for stop_word in stop_file)
+    return _stop_words_lists[language]
+
+
 class StopWords(object):
-    
+
     def __init__(self):
-        
-        self.stop_words_lists = {}
         self.language = None
-        
-        stop_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stop')
-        
-        for root, dirs, files in os.walk(stop_dir):
-            for file in files:
-                if not file in ACTIVE_LISTS:
-                    continue
-                stop_file = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stop/', file), 'r')                
-                self.stop_words_lists[file] = []                
-                for stop_word in stop_file:
-                    self.stop_words_lists[file].append(stop_word.strip().lower())
-                stop_file.close()
+        self.stop_words = None
 
     def load_language(self, language):
+        self.stop_words = load_stop_words(language)
         self.language = language
-                    
+
     def is_stop_word(self, word):
         if not self.language:
             raise LookupError("No language loaded")
-        return word in self.stop_words_lists[self.language]
-    
+        return word.casefold() in self.stop_words
+
     def guess(self, words):
-        currentWinner = ACTIVE_LISTS[0];
-        currentMax = 0;
-        
-        for language, stop_word_list in list(self.stop_words_lists.items()):
-            count = 0
+        """
+        The active language with the most stop words in words, an iterable
+        of words or a mapping of word counts
+        """
+        if not hasattr(words, 'items'):
+            counts = {}
             for word in words:
-                if word.encode('ascii', 'ignore') in stop_word_list:
-                    count += 1
-                    
+                counts[word] = counts.get(word, 0) + 1
+            words = counts
+        folded = {}
+        for word, count in words.items():
+            word = word.casefold()
+            folded[word] = folded.get(word, 0) + count
+
+        currentWinner = ACTIVE_LISTS[0]
+        currentMax = 0
+
+        for language in ACTIVE_LISTS:
+            stop_word_list = load_stop_words(language)
+            count = sum(count for word, count in folded.items()
+                        if word in stop_word_list)
             if count > currentMax:
                 currentWinner = language
                 currentMax = count
-        
+
         return currentWinner
-    
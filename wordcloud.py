@@ -10,24 +10,40 @@
 
 """
 
-from pytagcloud import create_tag_image, make_tags, LAYOUT_MIX
-from pytagcloud.lang.counter import get_tag_counts
-
 import sys
 import os
+import logging
+
+# keep pygame's banner off stdout, the --serve protocol runs over it
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from pytagcloud import create_tag_image, make_tags, LAYOUT_MIX, \
+    ENGINE_OCCUPANCY
+from pytagcloud.lang.counter import get_tag_counts
+from pytagcloud.lang.stopwords import StopWords
+
+import pygame
 import gi
 
 gi.require_version('Gdk', '3.0')
 
 from gi.repository import Gdk
 
-from io import StringIO
+from io import BytesIO, StringIO
 
 import json
 json.dumps
 from json import load as jload
 from json import dump as jdump
 
+STOP_WORDS_ERROR = 255  # all of the words are stop words
+MAX_WORDS = 1000  # smaller words would not be legible anyway
+MAX_STEPS = 100000  # spiral steps a word gets before it is retried
+LAYOUT_TIMEOUT = 30  # seconds, words not placed by then are left out
+LAYOUT_SCALE = 0.5  # words are laid out at half size, drawn full size
+# one mask of the placed words, the engine that gains from LAYOUT_SCALE
+LAYOUT_ENGINE = ENGINE_OCCUPANCY
+
 
 def json_load(text):
     """ Load JSON data using what ever resources are available. """
@@ -52,32 +68,21 @@ def json_dump(data):
 
 class WordCloud():
 
-    def __init__(self):
-        try:
-            fd = open('/tmp/cloud_data.txt', 'r')
-            data = fd.read()
-            fd.close()
-            cloud_dict = json_load(data)
-            self._repeat_tags = cloud_dict['repeat']
-            self._layout = cloud_dict['layout']
-            self._font_name = cloud_dict['font']
-            self._color_scheme = cloud_dict['colors']
-        except:
-            self._repeat_tags = False
-            self._layout = LAYOUT_MIX
-            self._font_name = None
-            self._color_scheme = ((241, 143, 0), (128, 186, 39),
-                                  (13, 147, 210), (231, 30, 108),
-                                  (135, 135, 135))
-        try:
-            fd = open('/tmp/cloud_text.txt', 'r')
-            self._text = fd.read()
-            fd.close()
-        except:
-            self._text = 'Could not read cloud_text'
-
-    def run(self):
-        self._create_image(self._text)
+    def __init__(self, request, stop_words=None, progress=None):
+        self._stop_words = stop_words
+        self._progress = progress
+        self._repeat_tags = request.get('repeat', False)
+        self._layout = request.get('layout', LAYOUT_MIX)
+        self._font_name = request.get('font')
+        self._color_scheme = request.get('colors',
+                                         ((241, 143, 0), (128, 186, 39),
+                                          (13, 147, 210), (231, 30, 108),
+                                          (135, 135, 135)))
+        self._text = request.get('text', '')
+
+    def run(self, output):
+        """ Write the cloud to output as png, returns the exit status """
+        return self._create_image(self._text, output)
 
     def get_display_rectangle(self):
         display = Gdk.Display.get_default()
@@ -88,10 +93,10 @@ class WordCloud():
         height = scale_factor * geometry.height
         return (width, height)
 
-    def _create_image(self, text):
-        tag_counts = get_tag_counts(text)
+    def _create_image(self, text, output):
+        tag_counts = get_tag_counts(text, self._stop_words)
         if tag_counts is None:
-            sys.exit(-1)
+            return STOP_WORDS_ERROR
 
         if self._repeat_tags:
             expanded_tag_counts = []
@@ -103,8 +108,8 @@ class WordCloud():
                 expanded_tag_counts.append((tag[0], 1))
             tag_counts = expanded_tag_counts
 
-        tags = make_tags(tag_counts, maxsize=150, colors=self._color_scheme)
-        path = os.path.join('/tmp/cloud_large.png')
+        tags = make_tags(tag_counts, maxsize=150, colors=self._color_scheme,
+                         max_words=MAX_WORDS)
 
         width, height = self.get_display_rectangle()
 
@@ -116,16 +121,75 @@ class WordCloud():
             height = int(width * ratio)
 
         if self._font_name is not None:
-            create_tag_image(tags, path, layout=self._layout,
+            create_tag_image(tags, output, layout=self._layout,
                              size=(width, height),
-                             fontname=self._font_name)
+                             fontname=self._font_name,
+                             progress=self._progress,
+                             max_steps=MAX_STEPS,
+                             timeout=LAYOUT_TIMEOUT,
+                             engine=LAYOUT_ENGINE,
+                             layout_scale=LAYOUT_SCALE)
         else:
-            create_tag_image(tags, path, layout=self._layout,
-                             size=(width, height))
+            create_tag_image(tags, output, layout=self._layout,
+                             size=(width, height),
+                             progress=self._progress,
+                             max_steps=MAX_STEPS,
+                             timeout=LAYOUT_TIMEOUT,
+                             engine=LAYOUT_ENGINE,
+                             layout_scale=LAYOUT_SCALE)
         return 0
 
 
+def serve():
+    """
+    Render clouds until stdin closes. Each request is a line of JSON with
+    the text and options. Each reply is a line of JSON with the status
+    and the png length, followed by that many bytes of png. Requests with
+    'progress' set first get {'placed': n, 'total': m} lines.
+    pygame, the fonts and the stop words stay loaded between requests.
+    """
+    # stray prints would corrupt the replies, send them to stderr
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def progress(placed, total):
+        # one line per percent is plenty for a progress bar
+        if placed * 100 // total != (placed - 1) * 100 // total:
+            line = json_dump({'placed': placed, 'total': total}) + '\n'
+            replies.write(line.encode('utf-8'))
+            replies.flush()
+
+    pygame.init()
+    stop_words = StopWords()
+    for line in sys.stdin.buffer:
+        if not line.strip():
+            continue
+        output = BytesIO()
+        try:
+            request = json_load(line.decode('utf-8'))
+            status = WordCloud(request, stop_words,
+                               progress if request.get('progress')
+                               else None).run(output)
+            reply = {'status': status}
+        except Exception as e:
+            logging.exception('render failed')
+            reply = {'status': 1, 'error': str(e)}
+        png = output.getvalue() if reply['status'] == 0 else b''
+        reply['length'] = len(png)
+        replies.write((json_dump(reply) + '\n').encode('utf-8'))
+        replies.write(png)
+        replies.flush()
+    pygame.quit()
+
+
 if __name__ == "__main__":
-    game = WordCloud()
-    game.run()
-    sys.exit(0)
+    if '--serve' in sys.argv[1:]:
+        serve()
+        sys.exit(0)
+    # one cloud: the JSON request on stdin, the png on stdout
+    game = WordCloud(json_load(sys.stdin.read()))
+    output = BytesIO()
+    status = game.run(output)
+    if status == 0:
+        sys.stdout.buffer.write(output.getvalue())
+    sys.exit(status)